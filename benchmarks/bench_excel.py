@@ -0,0 +1,114 @@
+"""
+Benchmark of the supplier sheet writers
+
+Compares DataFrame.to_excel + XlsxWriterEditor.format_worksheet against
+XlsxWriterEditor.write_worksheet on a synthetic 'Teleferia' sheet.
+
+Usage:
+    python -m benchmarks.bench_excel [rows]
+"""
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+import pandas as pd
+from xlsxwriter import Workbook
+from server.excel import XlsxWriterEditor
+from server.report import EmesReport
+
+
+def make_sheet(rows: int) -> pd.DataFrame:
+    """
+    Random dataframe with the columns and dtypes of a 'Teleferia' sheet
+    """
+    rng = np.random.default_rng(0)
+
+    text = lambda prefix, n: pd.array(
+        [f'{prefix} {i}' for i in rng.integers(0, n, rows)],
+        dtype='string'
+    )
+
+    return pd.DataFrame({
+        'Grupo': text('100-PROVEEDOR', 1),
+        'Subgrupo': text('Subgrupo', 5),
+        'Código': text('C', 500),
+        'Descripción': text('Producto de prueba', 500),
+        'Bodega': text('B', 3),
+        'Id Cliente': text('', 3000),
+        'Cliente': text('Cliente de prueba', 3000),
+        'Tipo': text('FV', 1),
+        'Número': text('', 10 ** 6),
+        'Cantidad': pd.array(rng.integers(1, 50, rows), dtype='Float64'),
+        'Precio Neto': pd.array(rng.uniform(0, 1e5, rows), dtype='Float64'),
+        '% Descuento': pd.array(rng.choice([.05, .1, .2], rows), dtype='Float64'),
+        'Nota': pd.array(rng.uniform(0, 1e4, rows), dtype='Float64'),
+        'Vendedor': text('V', 20),
+        'NIT': pd.array(rng.integers(8e5, 9e5, rows), dtype='Int64'),
+        'Sigla': text('SG', 1),
+    })
+
+
+def with_to_excel(df: pd.DataFrame, path: str) -> None:
+    with pd.ExcelWriter(path, engine='xlsxwriter') as writer:
+        xlsx = XlsxWriterEditor(writer.book)
+
+        df.to_excel(writer, sheet_name='Teleferia', index=False)
+
+        xlsx.format_worksheet(
+            df=df,
+            worksheet=writer.sheets['Teleferia'],
+            prices_cols=EmesReport.PRICES,
+            left_align_cols=EmesReport.LEFT_ALIGN,
+            perc_cols=['% Descuento'],
+            include_sum=True
+        )
+
+
+def with_write_worksheet(
+        df: pd.DataFrame,
+        path: str,
+        constant_memory: bool = False) -> None:
+    with Workbook(path, {'constant_memory': constant_memory}) as wb:
+        xlsx = XlsxWriterEditor(wb)
+
+        xlsx.write_worksheet(
+            df=df,
+            worksheet=wb.add_worksheet('Teleferia'),
+            prices_cols=EmesReport.PRICES,
+            left_align_cols=EmesReport.LEFT_ALIGN,
+            perc_cols=['% Descuento'],
+            include_sum=True
+        )
+
+
+def timeit(fn, *args, repeat: int = 3) -> float:
+    best = float('inf')
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(*args)
+        best = min(best, time.perf_counter() - start)
+
+    return best
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 20_000
+    df = make_sheet(rows)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.xlsx')
+
+        base = timeit(with_to_excel, df, path)
+        direct = timeit(with_write_worksheet, df, path)
+        streamed = timeit(with_write_worksheet, df, path, True)
+
+    print(f'rows: {rows}')
+    print(f'to_excel:                  {base:.3f} s')
+    print(f'write_worksheet:           {direct:.3f} s ({base / direct:.1f}x)')
+    print(f'write_worksheet (stream):  {streamed:.3f} s ({base / streamed:.1f}x)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""
+Benchmark of the per-supplier report pipeline
+
+Builds the sheets of every supplier of a synthetic 260 report, without
+saving workbooks (EmesReport.run with use_mode=False), and reports the
+time and the peak of memory allocated while building them.
+
+Usage:
+    python -m benchmarks.bench_report [rows] [suppliers]
+"""
+import os
+import sys
+import time
+import tempfile
+import tracemalloc
+import numpy as np
+import pandas as pd
+from server.report import EmesReport
+
+HEADER = [
+    'Grupo', 'Id', 'Subgrupo', 'Código', 'Descripción', 'porcentaje_iva',
+    'Bodega', 'Id Cliente', 'Cliente', 'Tipo', 'Número', 'fecha_factura',
+    'Cantidad', 'Precio Neto', 'porcentaje_iva3', 'Precio+Iva',
+    'Costo Total', 'Valor Utilidad', 'Costo Unidad', '%Uti',
+    'Valor descuento', '% Descuento', 'notas', 'Vendedor',
+    'vendedor_operacion', 'NIT', 'direccion', 'Ciudad', 'Sigla',
+    'Subgrupo3', 'Subgrupo4', 'Subgrupo5', 'linea', 'Alterna'
+]
+
+
+def make_inputs(path: str, rows: int, suppliers: int) -> tuple[str, str]:
+    """
+    Write a random 260 report and its "proveedores" file
+
+    Returns:
+        tuple[str, str]: (csv path, xlsx path)
+    """
+    rng = np.random.default_rng(0)
+
+    names = [f'{100 + i}-PROVEEDOR {i}' for i in range(suppliers)]
+    codes = rng.integers(1, 200, rows).astype(str)
+    price = rng.uniform(0, 5e4, rows)
+    money = lambda values: [f'${v:,.2f}' for v in values]
+
+    df = pd.DataFrame({col: '' for col in HEADER}, index=range(rows))
+
+    df['Grupo'] = rng.choice(names, rows)
+    df['Subgrupo'] = rng.choice(['SG', 'Bonificados'], rows, p=[.97, .03])
+    df['Código'] = np.char.add('C', codes)
+    df['Descripción'] = np.char.add('Producto de prueba ', codes)
+    df['Id Cliente'] = rng.integers(1, 3000, rows).astype(str)
+    df['Cliente'] = np.char.add('Cliente de prueba ', df['Id Cliente'].to_numpy(str))
+    df['Número'] = np.arange(rows).astype(str)
+    df['fecha_factura'] = [f'{d:02d}-ene.-2023' for d in rng.integers(1, 32, rows)]
+    df['Cantidad'] = rng.integers(1, 20, rows).astype(str)
+    df['Precio Neto'] = money(price)
+    df['Costo Total'] = money(price * .7)
+    df['Valor descuento'] = money(price * .05)
+    df['% Descuento'] = rng.choice(['0', '5', '10'], rows)
+    df['NIT'] = rng.integers(8e5, 9e5, rows).astype(str)
+
+    path_csv = os.path.join(path, 'report.csv')
+    df.to_csv(path_csv, sep=';', index=False)
+
+    base = pd.DataFrame(
+        {'Base descuento': rng.choice([1, 2], suppliers)},
+        index=pd.Index(names, name='Proveedor')
+    )
+
+    discounts = pd.DataFrame(
+        {
+            'Codigo': [
+                '0' if i % 2 else f'C{rng.integers(1, 200)}'
+                for i in range(suppliers)
+            ],
+            'Descripción': 'x',
+            'Fecha': '1_10;20_28',
+            '% Desc real': .1
+        },
+        index=pd.Index(names, name='Proveedor')
+    )
+
+    path_groups = os.path.join(path, 'proveedores.xlsx')
+
+    with pd.ExcelWriter(path_groups) as writer:
+        base.to_excel(writer, sheet_name='Base')
+        discounts.to_excel(writer, sheet_name='Descuentos')
+
+    return path_csv, path_groups
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    suppliers = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path_csv, path_groups = make_inputs(tmp, rows, suppliers)
+
+        report = EmesReport(path_csv, tmp, path_groups)
+
+        tracemalloc.start()
+        start = time.perf_counter()
+
+        report.run(use_mode=False)
+
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    print(f'rows: {rows}, suppliers: {suppliers}')
+    print(f'time:          {elapsed:.3f} s ({elapsed / suppliers * 1e3:.1f} ms per supplier)')
+    print(f'peak memory:   {peak / 2 ** 20:.1f} MiB')
+
+
+if __name__ == '__main__':
+    main()
@@ -7,7 +7,7 @@ def main():
     path_groups = path_main + '\\data'
     path_to = path_main + '\\reports\\Diciembre'
 
-    file_name = r'C:\SMD_FILES\grid_export\Grd_20230201083735.pkl'
+    file_name = r'C:\SMD_FILES\grid_export\Grd_20230201083735.csv'
 
     emes = EmesReport(file_name,
                       path_to,
@@ -0,0 +1,256 @@
+import time
+import numpy as np
+
+# seconds spent by closest_fit on each supplier
+TIME_BUDGET = 0.05
+
+
+def reallocate(notes: np.ndarray, total: float) -> np.ndarray:
+    """
+    Rows of one supplier added to its discount period
+
+    Args:
+        notes (np.ndarray): 'Nota' of the out-of-period rows, descending
+        total (float): Amount to reallocate
+
+    Returns:
+        np.ndarray: True for the selected rows
+    """
+    return reallocate_batched(
+        notes,
+        np.array([0, len(notes)]),
+        np.array([total], dtype=float)
+    )
+
+
+def reallocate_batched(
+        notes: np.ndarray,
+        offsets: np.ndarray,
+        totals: np.ndarray) -> np.ndarray:
+    """
+    Rows of every supplier added to its discount period, in one pass.
+    Rows are taken in order while the cumulative 'Nota' stays within the
+    total, plus the next one, which reaches it. If the last row is still
+    within the total, every row within it is taken.
+
+    Args:
+        notes (np.ndarray): 'Nota' of the out-of-period rows, grouped by
+            supplier and descending within each supplier
+        offsets (np.ndarray): Start of each supplier in notes, plus the end
+        totals (np.ndarray): Amount to reallocate of each supplier, NaN to
+            skip it
+
+    Returns:
+        np.ndarray: True for the selected rows
+    """
+    notes = np.asarray(notes, dtype=float)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    totals = np.asarray(totals, dtype=float)
+
+    n = len(notes)
+
+    if n == 0:
+        return np.zeros(0, dtype=bool)
+
+    sizes = np.diff(offsets)
+
+    # cumulative sum restarted at each supplier
+    cumsum = np.cumsum(notes)
+    before = np.concatenate([[0.0], cumsum])[offsets[:-1]]
+    cumsum -= np.repeat(before, sizes)
+
+    within = cumsum <= np.repeat(totals, sizes)
+
+    # last row within the total of each supplier, -1 if none
+    rows = np.arange(n)
+    last = np.full(len(sizes), -1)
+    filled = sizes > 0
+
+    last[filled] = np.maximum.reduceat(
+        np.where(within, rows, -1),
+        offsets[:-1][filled]
+    )
+
+    last = np.repeat(last, sizes)
+    stop = np.repeat(offsets[1:], sizes)
+
+    return (last >= 0) & np.where(
+        last == stop - 1,
+        within,
+        rows <= last + 1
+    )
+
+
+def closest_fit(
+        notes: np.ndarray,
+        total: float,
+        budget: float = TIME_BUDGET) -> np.ndarray:
+    """
+    Rows of one supplier whose 'Nota' adds up as close as possible to the
+    total, by approximate subset sum within a time budget: first fit
+    decreasing, then swaps of one selected row for one unselected row that
+    close the gap. The smallest unselected row is finally added if it
+    overshoots the total by less than the remaining gap. The greedy
+    selection is kept if it is closer, or if the budget runs out first.
+
+    Args:
+        notes (np.ndarray): 'Nota' of the out-of-period rows, descending
+        total (float): Amount to reallocate
+        budget (float): Seconds to spend, steps that would not end within
+            them are not started
+
+    Returns:
+        np.ndarray: True for the selected rows
+    """
+    notes = np.asarray(notes, dtype=float)
+    selected = np.zeros(len(notes), dtype=bool)
+
+    if not total > 0:
+        return selected
+
+    began = time.perf_counter()
+    deadline = began + budget
+
+    greedy = reallocate(notes, total)
+    greedy_gap = abs(notes[greedy].sum() - total)
+
+    # rows that add to the discount, already descending
+    candidates = np.flatnonzero(notes > 0)
+
+    values = notes[candidates]
+    taken = np.zeros(len(values), dtype=bool)
+
+    # each pass costs about as much as the setup, at first
+    step = time.perf_counter() - began
+
+    gap = _fill(values, taken, total, deadline, step)
+
+    while gap > 0 and time.perf_counter() + step < deadline:
+        began = time.perf_counter()
+
+        inside = np.flatnonzero(taken)
+        outside = np.flatnonzero(~taken)[::-1]
+
+        if not len(inside) or not len(outside):
+            break
+
+        # largest unselected row that fits in place of each selected row
+        j = np.searchsorted(
+            values[outside],
+            values[inside] + gap,
+            side='right'
+        ) - 1
+
+        gain = np.where(
+            j >= 0,
+            values[outside[np.maximum(j, 0)]] - values[inside],
+            -np.inf
+        )
+
+        best = np.argmax(gain)
+
+        if not gain[best] > 0:
+            break
+
+        taken[inside[best]] = False
+        taken[outside[j[best]]] = True
+
+        gap = _fill(values, taken, gap - gain[best], deadline, step)
+        step = time.perf_counter() - began
+
+    if time.perf_counter() >= deadline:
+        return greedy
+
+    # bounded overshoot
+    outside = np.flatnonzero(~taken)
+
+    if gap > 0 and len(outside):
+        last = outside[-1]
+
+        if values[last] - gap < gap:
+            taken[last] = True
+
+    selected[candidates[taken]] = True
+
+    if greedy_gap < abs(notes[selected].sum() - total):
+        return greedy
+
+    return selected
+
+
+def closest_fit_batched(
+        notes: np.ndarray,
+        offsets: np.ndarray,
+        totals: np.ndarray,
+        budget: float = TIME_BUDGET) -> np.ndarray:
+    """
+    closest_fit of every supplier, same arguments as reallocate_batched
+
+    Returns:
+        np.ndarray: True for the selected rows
+    """
+    selected = np.zeros(len(notes), dtype=bool)
+
+    for start, stop, total in zip(offsets[:-1], offsets[1:], totals):
+        if stop > start and total > 0:
+            selected[start:stop] = closest_fit(
+                notes[start:stop],
+                total,
+                budget
+            )
+
+    return selected
+
+
+def _fill(
+        values: np.ndarray,
+        taken: np.ndarray,
+        gap: float,
+        deadline: float,
+        step: float = 0.0) -> float:
+    """
+    First fit decreasing of the unselected values into the gap
+
+    Args:
+        values (np.ndarray): Descending values
+        taken (np.ndarray): Selected values, updated in place
+        gap (float): Amount left to the total
+        deadline (float): time.perf_counter() limit
+        step (float): Expected seconds of the first pass, no pass is
+            started unless it is expected to end before the deadline
+
+    Returns:
+        float: Amount left to the total
+    """
+    free = np.flatnonzero(~taken)
+    free_values = values[free]
+    start = 0
+
+    while start < len(free) and time.perf_counter() + step < deadline:
+        began = time.perf_counter()
+
+        # first value that fits, then the longest run of values that fit
+        start += np.searchsorted(-free_values[start:], -gap, side='left')
+
+        if start >= len(free):
+            break
+
+        run = np.searchsorted(
+            np.cumsum(free_values[start:]),
+            gap,
+            side='right'
+        )
+
+        taken[free[start:start + run]] = True
+        gap -= free_values[start:start + run].sum()
+        start += run
+        step = time.perf_counter() - began
+
+    return gap
+
+
+# reallocation strategies, by name
+STRATEGIES = {
+    'greedy': reallocate_batched,
+    'closest': closest_fit_batched
+}
@@ -1,14 +1,35 @@
+import queue
+import logging
+import threading
 from xlsxwriter import Workbook
 from xlsxwriter.worksheet import Worksheet
+import numpy as np
+import pandas as pd
 from pandas.core.frame import DataFrame
+from pandas.core.series import Series
 
 
 class XlsxWriterEditor:
 
     ROW_HEIGHT = 18
 
-    def __init__(self, wb: Workbook) -> None:
+    DATE_FORMAT = 'dd/mm/yyyy'
+
+    # text columns longer than this are sized from a sample, None to disable
+    SAMPLE_ROWS = None
+
+    # rows converted at once by write_worksheet, bounds its memory
+    BLOCK_ROWS = 4096
+
+    def __init__(self, wb: Workbook, widths: dict = None) -> None:
+        """
+        Args:
+            wb (Workbook): workbook to edit
+            widths (dict, optional): column widths cache shared across
+                workbooks, keyed by (key, column, rows, content hash)
+        """
         self.__workbook = wb
+        self.__widths = widths if widths is not None else {}
         self.__set_formats()
 
     def __set_formats(self) -> None:
@@ -58,9 +79,77 @@ class XlsxWriterEditor:
             common_format
         )
 
+        # set dates format
+        common_format['num_format'] = XlsxWriterEditor.DATE_FORMAT
+
+        self.date_format = self.__workbook.add_format(
+            common_format
+        )
+
     @staticmethod
     def get_column_width(df: DataFrame, col: int) -> int:
-        return max(df[col].astype(str).map(len).max(), len(col)) + 5
+        values = df[col]
+
+        if pd.api.types.is_bool_dtype(values):
+            width = 5
+        elif pd.api.types.is_numeric_dtype(values):
+            width = XlsxWriterEditor.__get_numeric_width(values)
+        elif pd.api.types.is_datetime64_any_dtype(values):
+            width = len(XlsxWriterEditor.DATE_FORMAT)
+        elif pd.api.types.is_string_dtype(values) and values.dtype != object:
+            width = XlsxWriterEditor.__get_text_width(values)
+        else:
+            width = values.astype(str).map(len).max()
+
+        return max(0 if pd.isna(width) else int(width), len(col)) + 5
+
+    @staticmethod
+    def __get_numeric_width(values: Series) -> int:
+        """
+        Width of the formatted min and max values
+        """
+        values = values.dropna()
+
+        if values.empty:
+            return 0
+
+        if pd.api.types.is_integer_dtype(values):
+            edges = [str(values.min()), str(values.max())]
+        else:
+            edges = [f'{values.min():,.2f}', f'{values.max():,.2f}']
+
+        return max(map(len, edges))
+
+    @staticmethod
+    def __get_text_width(values: Series) -> int:
+        """
+        Longest text, from a sample of very large columns
+        """
+        limit = XlsxWriterEditor.SAMPLE_ROWS
+
+        if limit is not None and len(values) > limit:
+            values = values.sample(limit, random_state=0)
+
+        return values.str.len().max()
+
+    def __get_cached_width(self, df: DataFrame, col: str, key) -> int:
+        """
+        Column width, reused from the cache when the same column of the
+        same sheet, size and contents was already measured
+        """
+        if key is None:
+            return XlsxWriterEditor.get_column_width(df, col)
+
+        # order does not change the width, so the row hashes are summed
+        content = pd.util.hash_pandas_object(df[col], index=False).sum()
+
+        cache_key = (key, col, len(df), int(content))
+
+        if cache_key not in self.__widths:
+            self.__widths[cache_key] = \
+                XlsxWriterEditor.get_column_width(df, col)
+
+        return self.__widths[cache_key]
 
     def format_worksheet(self,
                          df: DataFrame,
@@ -68,7 +157,8 @@ class XlsxWriterEditor:
                          prices_cols: list,
                          left_align_cols: list,
                          perc_cols: list = [],
-                         include_sum: bool = False) -> None:
+                         include_sum: bool = False,
+                         key=None) -> None:
         """
         Args:
             df (DataFrame): dataframe to edit
@@ -77,32 +167,26 @@ class XlsxWriterEditor:
             left_align_cols (list): left align format cols
             perc_cols (list): percentage format cols
             include_sum (bool, optional): sum subtotals. Defaults to False.
+            key (optional): reuse cached column widths, e.g. (supplier, sheet)
         """
         # get dimensions
         max_row, max_col = df.shape
 
-        extra_rows = 2 if include_sum else 1
-
         # remove grid lines
         worksheet.hide_gridlines(2)
 
-        # format each row
-        for row in range(max_row + extra_rows):
-            if row == 0:
-                worksheet.set_row(
-                    row,
-                    XlsxWriterEditor.ROW_HEIGHT,
-                    self.head_format
-                )
-            else:
-                worksheet.set_row(
-                    row,
-                    XlsxWriterEditor.ROW_HEIGHT
-                )
+        # row height of every row, header format on the first one
+        worksheet.set_default_row(XlsxWriterEditor.ROW_HEIGHT)
+
+        worksheet.set_row(
+            0,
+            XlsxWriterEditor.ROW_HEIGHT,
+            self.head_format
+        )
 
         # format each col
         for col_idx, col in enumerate(df):
-            column_width = XlsxWriterEditor.get_column_width(df, col)
+            column_width = self.__get_cached_width(df, col, key)
 
             if col in prices_cols:
                 new_format = self.price_format
@@ -121,10 +205,10 @@ class XlsxWriterEditor:
                 new_format
             )
 
-            # ignore most common error
-            worksheet.ignore_errors({
-                'number_stored_as_text': f'C1:I{max_row + 1}'
-            })
+        # ignore most common error
+        worksheet.ignore_errors({
+            'number_stored_as_text': f'C1:I{max_row + 1}'
+        })
 
         total_cols = prices_cols + ['Cantidad']
 
@@ -150,6 +234,16 @@ class XlsxWriterEditor:
                 for column in df.columns
             ]
 
+        # add_table is refused in constant_memory mode; the table is still
+        # registered here and write_worksheet writes its cells in row order
+        constant_memory = worksheet.constant_memory
+        worksheet.constant_memory = False
+
+        # add_table records every cell of its range to detect overlaps, so
+        # its memory grows with the sheet; the sheet has one table only
+        table_cells = worksheet.table_cells
+        worksheet.table_cells = _UnrecordedCells()
+
         # create table
         if include_sum:
             worksheet.add_table(
@@ -172,3 +266,224 @@ class XlsxWriterEditor:
                     'columns': column_settings,
                 }
             )
+
+        worksheet.constant_memory = constant_memory
+        worksheet.table_cells = table_cells
+
+    def write_worksheet(self,
+                        df: DataFrame,
+                        worksheet: Worksheet,
+                        prices_cols: list,
+                        left_align_cols: list,
+                        perc_cols: list = [],
+                        include_sum: bool = False,
+                        key=None) -> None:
+        """
+        Write the dataframe with the format_worksheet layout, straight from
+        its column arrays. Rows are written in order, so the worksheet may
+        belong to a constant_memory workbook.
+
+        Args:
+            df (DataFrame): dataframe to write
+            worksheet (Worksheet): empty worsheet object
+            prices_cols (list): price format cols
+            left_align_cols (list): left align format cols
+            perc_cols (list): percentage format cols
+            include_sum (bool, optional): sum subtotals. Defaults to False.
+            key (optional): reuse cached column widths, e.g. (supplier, sheet)
+        """
+        self.format_worksheet(
+            df=df,
+            worksheet=worksheet,
+            prices_cols=prices_cols,
+            left_align_cols=left_align_cols,
+            perc_cols=perc_cols,
+            include_sum=include_sum,
+            key=key
+        )
+
+        # header, formatted by the first row format
+        worksheet.write_row(0, 0, df.columns.to_list())
+
+        writers = [
+            self.__get_cell_writer(worksheet, df[col])
+            for col in df
+        ]
+
+        # typed writes, skipping pandas cell objects and type sniffing, from
+        # blocks of BLOCK_ROWS rows so memory does not grow with the sheet
+        for start in range(0, df.shape[0], XlsxWriterEditor.BLOCK_ROWS):
+            block = df.iloc[start:start + XlsxWriterEditor.BLOCK_ROWS]
+
+            columns = [
+                XlsxWriterEditor.__get_block_values(block[col])
+                for col in block
+            ]
+
+            for row, values in enumerate(zip(*columns), start=start + 1):
+                for col_idx, value in enumerate(values):
+                    if value is not None:
+                        writers[col_idx](row, col_idx, value)
+
+        if not include_sum:
+            return
+
+        # totals row, as add_table writes it
+        total_cols = prices_cols + ['Cantidad']
+
+        for col_idx, col in enumerate(df):
+            if col in total_cols:
+                worksheet.write_formula(
+                    df.shape[0] + 1,
+                    col_idx,
+                    f'SUBTOTAL(109,[{XlsxWriterEditor.__escape(col)}])',
+                    None,
+                    0
+                )
+
+    @staticmethod
+    def __get_block_values(values: Series) -> list:
+        """
+        Cell values of a block of rows, None for missing values. Numbers
+        and strings come from native arrays instead of boxed pandas scalars.
+
+        Args:
+            values (Series): column values of the block
+
+        Returns:
+            list: one value per row
+        """
+        if pd.api.types.is_bool_dtype(values):
+            return values.to_numpy(dtype=object, na_value=None).tolist()
+
+        if pd.api.types.is_numeric_dtype(values):
+            array = values.to_numpy(dtype=float, na_value=np.nan)
+            cells = array.tolist()
+
+            for row in np.flatnonzero(np.isnan(array)):
+                cells[row] = None
+
+            return cells
+
+        if pd.api.types.is_datetime64_any_dtype(values):
+            return [
+                None if pd.isna(value) else value
+                for value in values.dt.to_pydatetime()
+            ]
+
+        return values.to_numpy(dtype=object, na_value=None).tolist()
+
+    def __get_cell_writer(self, worksheet: Worksheet, values: Series):
+        """
+        Worksheet method that writes the values of a column
+
+        Args:
+            worksheet (Worksheet): worksheet object
+            values (Series): column values
+
+        Returns:
+            callable: function of (row, col, value)
+        """
+        if pd.api.types.is_bool_dtype(values):
+            return worksheet.write_boolean
+
+        if pd.api.types.is_numeric_dtype(values):
+            return worksheet.write_number
+
+        if pd.api.types.is_datetime64_any_dtype(values):
+            return lambda row, col, value: worksheet.write_datetime(
+                row, col, value, self.date_format
+            )
+
+        if pd.api.types.is_string_dtype(values) and values.dtype != object:
+            return worksheet.write_string
+
+        return worksheet.write
+
+    @staticmethod
+    def __escape(col: str) -> str:
+        """
+        Escape special characters of a column name in a table formula
+        """
+        return (
+            col
+            .replace("'", "''")
+            .replace('#', "'#")
+            .replace(']', "']")
+            .replace('[', "'[")
+        )
+
+
+class _UnrecordedCells(dict):
+    """
+    Cell map that keeps nothing, for Worksheet.table_cells
+    """
+
+    def __setitem__(self, key, value) -> None:
+        pass
+
+
+class ExcelWriterPool:
+    """
+    Writer threads fed by a bounded queue. submit() blocks while the queue
+    is full, so at most MAX_JOBS pending workbooks are kept in memory.
+    """
+
+    MAX_JOBS = 4
+
+    def __init__(self, write, workers: int = 2) -> None:
+        """
+        Args:
+            write (callable): function that saves one job into a workbook
+            workers (int): number of writer threads
+        """
+        self.__write = write
+        self.__jobs = queue.Queue(maxsize=ExcelWriterPool.MAX_JOBS)
+
+        self.__threads = [
+            threading.Thread(target=self.__work, daemon=True)
+            for _ in range(workers)
+        ]
+
+        for thread in self.__threads:
+            thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def __work(self) -> None:
+        """
+        Save jobs until the stop signal (None) is received
+        """
+        while True:
+            job = self.__jobs.get()
+
+            if job is None:
+                break
+
+            try:
+                self.__write(*job)
+            except Exception as e:
+                logging.error(
+                    f'Exception {e} occurred writing {job[0]}',
+                    exc_info=True
+                )
+
+    def submit(self, *job) -> None:
+        """
+        Queue a job, waiting for a free slot when the queue is full
+        """
+        self.__jobs.put(job)
+
+    def close(self) -> None:
+        """
+        Wait until every queued job is saved and stop the threads
+        """
+        for _ in self.__threads:
+            self.__jobs.put(None)
+
+        for thread in self.__threads:
+            thread.join()
@@ -1,12 +1,14 @@
-
 import os
-import csv
-import pickle
+import json
+import locale
 import calendar
 import logging
+import importlib.util
 import server.utils as utils
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
 from pandas.core.frame import DataFrame
 from pandas.core.series import Series
 from datetime import date
@@ -45,48 +47,237 @@ class Preprocessing:
             "% Descuento"
         ]
 
+    # input schema of the 260 report: target column -> (source spellings, dtype)
+    # dtypes are fixed so every chunk of a streamed report matches
+    SCHEMA = \
+        {
+            "Grupo": (("Grupo",), "string"),
+            "Subgrupo": (("Subgrupo",), "string"),
+            "Código": (("Código", "Codigo"), "string"),
+            "Descripción": (("Descripción", "Descripcion"), "string"),
+            "Bodega": (("Bodega",), "string"),
+            "Id Cliente": (("Id Cliente",), "string"),
+            "Cliente": (("Cliente",), "string"),
+            "Tipo": (("Tipo",), "string"),
+            "Número": (("Número", "Numero"), "string"),
+            "Fecha": (("fecha_factura", "Fecha"), "datetime64[ns]"),
+            "Cantidad": (("Cantidad",), "Float64"),
+            "Precio Neto": (("Precio Neto",), "Float64"),
+            "Costo Total": (("Costo Total",), "Float64"),
+            "Valor descuento": (("Valor descuento",), "Float64"),
+            "% Descuento": (("% Descuento",), "Float64"),
+            "Vendedor": (("Vendedor",), "string"),
+            "NIT": (("NIT",), "Int64"),
+            "Sigla": (("Sigla",), "string"),
+        }
+
+    # source columns never read from the 260 report
+    DROP_COLS = \
+        [
+            "Id",
+            "porcentaje_iva",
+            "porcentaje_iva3",
+            "Precio+Iva",
+            "Valor Utilidad",
+            "Costo Unidad",
+            "%Uti",
+            "notas",
+            "vendedor_operacion",
+            "direccion",
+            "Ciudad",
+            "Subgrupo3",
+            "Subgrupo4",
+            "Subgrupo5",
+            "linea",
+            "Alterna"
+        ]
+
+    # rows per chunk in streaming mode
+    CHUNK_SIZE = 100_000
+
+    # columnar cache of the 260 report, next to the source file
+    CACHE_EXT = '.feather'
+
+    # metadata key of the source fingerprint inside the cache
+    CACHE_KEY = b'emes_source'
+
+    # bump when SCHEMA or the parsing steps change
+    CACHE_VERSION = 3
+
+    # preprocessed report, base and discounts, next to the source file
+    PREP_EXT = '.prep.pkl'
+
+    # bump when any preprocessing step changes
+    PREP_VERSION = 5
+
+    # parsed "proveedores" sheets, next to the source file
+    GROUPS_EXT = '.groups.pkl'
+
+    # bump when the parsing of "proveedores" changes
+    GROUPS_VERSION = 1
+
+    # read-only Rust reader, used when installed (pip install python-calamine)
+    EXCEL_ENGINE = 'calamine' \
+        if importlib.util.find_spec('python_calamine') else None
+
     def __init__(self,
                  path_csv: str,
-                 path_groups: str):
+                 path_groups: str,
+                 streaming: bool = False):
         """
         Constructor
 
         Args:
             path_grid (str): path to 260 report
             path_groups (str): path to "proveedores" file
+            streaming (bool): read the 260 report in chunks of CHUNK_SIZE rows
         """
+        self.__streaming = streaming
+        self.__sources = [path_csv, path_groups]
+        self.__path_prep = os.path.splitext(path_csv)[0] + Preprocessing.PREP_EXT
+
+        # result of a previous run on the same files, run() is then skipped
+        self.__prepared = self.__read_prepared()
+
+        if self.__prepared:
+            return
+
         self.base, self.discounts = \
             self.__request_df_groups(path_groups)
 
-        # convert csv file into pkl file
-        path_pkl = self.__csv_to_pkl(path_csv)
+        # read main report (260) from its columnar cache
+        self.data = self.__read_file(path_csv)
 
-        # read main pickle file (260 report)
-        self.data = self.__read_file(path_pkl)
+    def __read_prepared(self) -> bool:
+        """
+        Load the preprocessed data if both source files are unchanged
 
-    def __csv_to_pkl(self, path_csv: str) -> str:
+        Returns:
+            bool: True if data, base, discounts and period were loaded
         """
-        Converts .csv file into .pkl file
+        if not os.path.exists(self.__path_prep):
+            return False
+
+        try:
+            prepared = utils.read_keyed_cache(
+                self.__path_prep,
+                self.__sources,
+                Preprocessing.PREP_VERSION
+            )
+
+            if prepared is None:
+                return False
+
+            self.data = prepared['data']
+            self.base = prepared['base']
+            self.discounts = prepared['discounts']
+            self.supplier_discounts = prepared['supplier_discounts']
+            self.product_discounts = prepared['product_discounts']
+            self.period = prepared['period']
+
+            return True
+
+        except Exception as e:
+            logging.error(
+                f'Excepción {e} al leer el archivo {self.__path_prep}',
+                exc_info=True
+            )
+
+            return False
+
+    def __write_prepared(self) -> None:
+        """
+        Store the preprocessed data, keyed by the fingerprints of the 260
+        report and the "proveedores" file
+        """
+        try:
+            prepared = {
+                'data': self.data,
+                'base': self.base,
+                'discounts': self.discounts,
+                'supplier_discounts': self.supplier_discounts,
+                'product_discounts': self.product_discounts,
+                'period': self.period
+            }
+
+            utils.write_keyed_cache(
+                self.__path_prep,
+                self.__sources,
+                Preprocessing.PREP_VERSION,
+                prepared
+            )
+
+        except Exception as e:
+            logging.error(
+                f'Excepción {e} al crear el archivo {self.__path_prep}',
+                exc_info=True
+            )
+
+    def __read_cache(self, path_cache: str, path_csv: str) -> DataFrame:
+        """
+        Read the columnar cache if it still matches the source file
 
         Args:
+            path_cache (str): Path to feather file
             path_csv (str): Path to csv file
 
         Returns:
-            str: Path to pickle file
+            DataFrame: Cached report, None if missing or outdated
         """
+        if not os.path.exists(path_cache):
+            return None
+
         try:
-            path_pkl = path_csv.replace('csv', 'pkl')
+            table = feather.read_table(path_cache, memory_map=True)
+            meta = table.schema.metadata or {}
+            fingerprint = json.loads(meta.get(Preprocessing.CACHE_KEY, b'{}'))
 
-            if not os.path.exists(path_pkl):
-                with open(path_csv, 'r') as f:
-                    reader = csv.reader(f, delimiter=";")
-                    pickle.dump(list(reader), open(path_pkl, 'wb'))
+            if fingerprint.pop('version', None) != Preprocessing.CACHE_VERSION:
+                return None
 
-            return path_pkl
+            if not utils.is_same_file(path_csv, fingerprint):
+                return None
+
+            return table.to_pandas()
 
         except Exception as e:
             logging.error(
-                f'Excepción {e} al crear el archivo .pkl',
+                f'Excepción {e} al leer el archivo {path_cache}',
+                exc_info=True
+            )
+
+            return None
+
+    def __write_cache(
+            self,
+            df: DataFrame,
+            path_cache: str,
+            path_csv: str) -> None:
+        """
+        Store typed report columns and the source fingerprint
+
+        Args:
+            df (DataFrame): Typed report
+            path_cache (str): Path to feather file
+            path_csv (str): Path to csv file
+        """
+        try:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+
+            meta = dict(table.schema.metadata or {})
+            meta[Preprocessing.CACHE_KEY] = json.dumps({
+                'version': Preprocessing.CACHE_VERSION,
+                **utils.file_fingerprint(path_csv)
+            })
+
+            feather.write_feather(
+                table.replace_schema_metadata(meta),
+                path_cache
+            )
+
+        except Exception as e:
+            logging.error(
+                f'Excepción {e} al crear el archivo {path_cache}',
                 exc_info=True
             )
 
@@ -94,7 +285,8 @@ class Preprocessing:
             self,
             path_groups: str) -> tuple[DataFrame, DataFrame]:
         """
-        Read Excel file and prepare dataframe
+        Read Excel file and prepare dataframe, from the cache when the
+        file is unchanged
 
         Args:
             path_groups (str): Path to groups file
@@ -103,20 +295,33 @@ class Preprocessing:
             tuple[DataFrame, DataFrame]: Price base and discounts dataframes
         """
         try:
+            path_cache = os.path.splitext(path_groups)[0] + \
+                Preprocessing.GROUPS_EXT
+
+            groups = self.__read_groups_cache(path_cache, path_groups)
+
+            if groups is not None:
+                return groups
+
             wb = pd.read_excel(
                 path_groups,
                 index_col=0,
-                sheet_name=None
+                sheet_name=['Base', 'Descuentos'],
+                engine=Preprocessing.EXCEL_ENGINE
             )
 
             df_base = wb['Base']
             df_desc = wb['Descuentos']
 
-            return (
+            groups = (
                 df_base,
                 df_desc.astype({'Codigo': 'string'})
             )
 
+            self.__write_groups_cache(path_cache, path_groups, groups)
+
+            return groups
+
         except Exception as e:
             logging.error(
                 f'No se pudo inicializar el dataframe de grupos. Exception: {e}',
@@ -125,91 +330,257 @@ class Preprocessing:
 
             return (pd.DataFrame() for _ in range(2))
 
-    def __read_file(self, path_grid: str) -> DataFrame:
+    def __read_groups_cache(self, path_cache: str, path_groups: str) -> tuple:
+        """
+        Args:
+            path_cache (str): Path to pickle file
+            path_groups (str): Path to groups file
+
+        Returns:
+            tuple[DataFrame, DataFrame]: Cached base and discounts, None if
+                missing or outdated
+        """
+        try:
+            return utils.read_keyed_cache(
+                path_cache,
+                [path_groups],
+                Preprocessing.GROUPS_VERSION
+            )
+
+        except Exception as e:
+            logging.error(
+                f'Excepción {e} al leer el archivo {path_cache}',
+                exc_info=True
+            )
+
+            return None
+
+    def __write_groups_cache(
+            self,
+            path_cache: str,
+            path_groups: str,
+            groups: tuple) -> None:
+        """
+        Args:
+            path_cache (str): Path to pickle file
+            path_groups (str): Path to groups file
+            groups (tuple): Parsed base and discounts
+        """
+        try:
+            utils.write_keyed_cache(
+                path_cache,
+                [path_groups],
+                Preprocessing.GROUPS_VERSION,
+                groups
+            )
+
+        except Exception as e:
+            logging.error(
+                f'Excepción {e} al crear el archivo {path_cache}',
+                exc_info=True
+            )
+
+    def __read_file(self, path_csv: str) -> DataFrame:
         """
-        Read main report file
+        Read main report file, from the cache when the source is unchanged
 
         Args:
-            path_grid (str): Path to pickle file
+            path_csv (str): Path to csv file
 
         Returns:
-            DataFrame: Report 260
+            DataFrame: Report 260 with typed columns
         """
-        data = pd.read_pickle(
-            path_grid
-        )
+        path_cache = os.path.splitext(path_csv)[0] + Preprocessing.CACHE_EXT
 
-        df = pd.DataFrame(data)
+        df = self.__read_cache(path_cache, path_csv)
 
-        df.columns = df.iloc[0]
-        df = df[1:]
-        df = df.set_index('Grupo', drop=True)
+        if df is None and self.__streaming:
+            df = self.__stream_file(path_csv, path_cache)
+
+        if df is None:
+            df = self.__parse_file(path_csv)
+            self.__write_cache(df, path_cache, path_csv)
 
         return df
 
-    def __drop_unneeded_rows(self, df: DataFrame) -> DataFrame:
+    def __stream_file(self, path_csv: str, path_cache: str) -> DataFrame:
         """
+        Parse the csv report chunk by chunk, appending each typed chunk
+        to the columnar cache, so memory does not grow with the report
+
         Args:
-            df (DataFrame): main dataframe
+            path_csv (str): Path to csv file
+            path_cache (str): Path to feather file
 
         Returns:
-            DataFrame: With removed rows
-        """
-        dropped_suppliers = list(
-            set(df.index) - set(self.base.index)
+            DataFrame: Report 260 with typed columns, None if it fails
+        """
+        self.__resolve_columns(path_csv)
+
+        reader = pd.read_csv(
+            path_csv,
+            sep=';',
+            usecols=list(self.__columns),
+            dtype=str,
+            keep_default_na=False,
+            encoding=locale.getpreferredencoding(False),
+            chunksize=Preprocessing.CHUNK_SIZE
         )
 
-        return df.drop(index=dropped_suppliers)
+        fingerprint = json.dumps({
+            'version': Preprocessing.CACHE_VERSION,
+            **utils.file_fingerprint(path_csv)
+        })
+        options = pa.ipc.IpcWriteOptions(compression='lz4')
+        writer, schema = None, None
+
+        try:
+            with reader:
+                for chunk in reader:
+                    table = pa.Table.from_pandas(
+                        self.__prepare(chunk),
+                        schema=schema,
+                        preserve_index=False
+                    )
+
+                    if writer is None:
+                        meta = dict(table.schema.metadata or {})
+                        meta[Preprocessing.CACHE_KEY] = fingerprint
+                        table = table.replace_schema_metadata(meta)
+                        schema = table.schema
+
+                        writer = pa.ipc.new_file(
+                            path_cache,
+                            table.schema,
+                            options=options
+                        )
+
+                    writer.write_table(table)
+
+            if writer is None:
+                return None
+
+            writer.close()
+
+            return feather.read_table(path_cache, memory_map=True).to_pandas()
+
+        except Exception as e:
+            logging.error(
+                f'Excepción {e} al leer por partes el archivo {path_csv}',
+                exc_info=True
+            )
+
+            if writer is not None:
+                writer.close()
+                os.remove(path_cache)
 
-    def __drop_unneeded_cols(self, df: DataFrame) -> DataFrame:
+            return None
+
+    def __parse_file(self, path_csv: str) -> DataFrame:
         """
+        Parse the csv report into typed columns
+
         Args:
-            df (DataFrame): main dataframe
+            path_csv (str): Path to csv file
 
         Returns:
-            DataFrame: dataframe with columns dropped
+            DataFrame: Report 260 with typed columns
         """
-        return df.drop(
-            [
-                "Id",
-                "porcentaje_iva",
-                "porcentaje_iva3",
-                "Precio+Iva",
-                "Valor Utilidad",
-                "Costo Unidad",
-                "%Uti",
-                "notas",
-                "vendedor_operacion",
-                "direccion",
-                "Ciudad",
-                "Subgrupo3",
-                "Subgrupo4",
-                "Subgrupo5",
-                "linea",
-                "Alterna"
-            ],
-            axis='columns'
+        self.__resolve_columns(path_csv)
+
+        df = pd.read_csv(
+            path_csv,
+            sep=';',
+            usecols=list(self.__columns),
+            dtype=str,
+            keep_default_na=False,
+            encoding=locale.getpreferredencoding(False)
         )
 
-    def __reset_index(self, df: DataFrame, drop: bool) -> DataFrame:
+        return self.__prepare(df)
+
+    def __resolve_columns(self, path_csv: str) -> None:
+        """
+        Match the report header against the SCHEMA spellings by name,
+        the first spelling present is read. Any other column is skipped.
+
+        Args:
+            path_csv (str): Path to csv file
+
+        Raises:
+            Exception: if a schema column is not in the header
+        """
+        header = pd.read_csv(
+            path_csv,
+            sep=';',
+            nrows=0,
+            encoding=locale.getpreferredencoding(False)
+        ).columns
+
+        columns, unmatched = {}, []
+
+        for target, (sources, _) in Preprocessing.SCHEMA.items():
+            source = next((col for col in sources if col in header), None)
+
+            if source is None:
+                unmatched.append(target)
+            else:
+                columns[source] = target
+
+        if unmatched:
+            raise Exception(f"Columns {unmatched} not found in the report")
+
+        ignored = [
+            col for col in header
+            if col not in columns and col not in Preprocessing.DROP_COLS
+        ]
+
+        if ignored:
+            logging.warning(
+                f'Columnas {ignored} del reporte 260 no se leen'
+            )
+
+        self.__columns = columns
+
+    def __prepare(self, df: DataFrame) -> DataFrame:
         """
-        Reset dataframe index
+        Drop, rename and type the columns of the raw report (or one chunk)
+
+        Args:
+            df (DataFrame): Raw report with string columns
+
+        Returns:
+            DataFrame: Report with typed columns
         """
-        return df.reset_index(
-            drop=drop
+        return (
+            df
+            .pipe(self.__set_column_names)
+            .pipe(self.__fill_nan_numeric_cols)
+            .pipe(self.__set_dtypes)
+            .pipe(self.__include_net_prices)
         )
 
+    def __drop_unneeded_rows(self, df: DataFrame) -> DataFrame:
+        """
+        Args:
+            df (DataFrame): main dataframe
+
+        Returns:
+            DataFrame: With removed rows
+        """
+        mask = df['Grupo'].isin(self.base.index)
+
+        return df[mask].reset_index(drop=True)
+
     def __set_column_names(self, df: DataFrame) -> DataFrame:
         """
-        Raises:
-            Exception: if columns does not match df columns
+        Rename source columns to their SCHEMA names, in COLS order
         """
-        if len(df.columns) == len(Preprocessing.COLS):
-            df.columns = Preprocessing.COLS
-            return df
-        else:
-            raise Exception("Columns of the dataframe must be the same"
-                            " as those in the list ")
+        return (
+            df
+            .rename(columns=self.__columns)
+            .reindex(columns=Preprocessing.COLS)
+        )
 
     def __fill_nan_numeric_cols(self, df: DataFrame) -> DataFrame:
         """
@@ -245,22 +616,15 @@ class Preprocessing:
                 .astype(float)
             )
 
-            df = (
-                df
-                .astype(
-                    {
-                        'NIT': 'int64',
-                        'Código': 'string'
-                    }
-                )
-                .convert_dtypes()
-            )
+            # rows of suppliers outside "proveedores" are still present here
+            df['NIT'] = pd.to_numeric(df['NIT'], errors='coerce')
 
-            df['Fecha'] = (
-                df['Fecha']
-                .apply(utils.format_datetime)
-                .dt.strftime('%d/%m/%Y')
-            )
+            df['Fecha'] = utils.parse_dates(df['Fecha'])
+
+            df = df.astype({
+                col: dtype
+                for col, (_, dtype) in Preprocessing.SCHEMA.items()
+            })
 
         except Exception as e:
             logging.error(
@@ -290,19 +654,19 @@ class Preprocessing:
 
         return df
 
-    def _create_date_ranges(self, row: Series) -> list:
+    def _create_date_ranges(self, row: Series) -> int:
         """
         Args:
             row (Series): dataframe row as Series object
 
         Returns:
-            list: contains all date ranges
+            int: day bitmask of all discount periods
         """
         dates = self.__get_discount_periods(
             dates=row['Fecha']
         )
 
-        # create pd date_range for each row
+        # create day bitmask for each row
         date_range = self.__create_date_range(
             year=self.__year,
             month=self.__month,
@@ -380,9 +744,9 @@ class Preprocessing:
             self,
             year: str,
             month: str,
-            discounts: list) -> list:
+            discounts: list) -> int:
         """
-        Create pandas date_range object
+        Create day bitmask of the discount periods
 
         Args:
             year (str): Period year
@@ -390,22 +754,22 @@ class Preprocessing:
             discounts (list): [prev, last] Day of each discount period
 
         Returns:
-            list: contains date_range objects
+            int: bit (day - 1) is set for every discount day of the month
         """
-        date_range = \
-            [
-                self.__get_date_range(start, end, month, year)
-                for start, end in discounts if self.__is_discount_valid(year, month, [start, end])
-            ]
+        date_range = 0
 
-        return sorted(set(sum(date_range, [])))
+        for start, end in discounts:
+            if self.__is_discount_valid(year, month, [start, end]):
+                date_range |= self.__get_date_range(start, end, month, year)
+
+        return date_range
 
     def __get_date_range(
             self,
             prev: int,
             last: int,
             month: int,
-            year: int) -> list:
+            year: int) -> int:
         """
         Args:
             prev (int): First day of discount
@@ -414,14 +778,130 @@ class Preprocessing:
             year (int): Year of report
 
         Returns:
-            list: Date range of discounts
+            int: Day bitmask of the discount range
+        """
+        prev, last = int(prev), int(last)
+
+        return ((1 << last) - 1) ^ ((1 << (prev - 1)) - 1)
+
+    def __compile_discounts(self) -> None:
+        """
+        Discount lookups, built once from the discounts sheet:
+
+        supplier_discounts: Proveedor -> (Todos, % Desc real, Rango), from
+            the first row of each supplier. Todos is True if its discount
+            applies to all products (Codigo '0').
+        product_discounts: (Proveedor, Codigo) -> (% Desc real, Rango),
+            first row of each product.
         """
-        return (pd.date_range(
-            start=f'{year}-{month}-{prev}',
-            end=f'{year}-{month}-{last}'
+        df = self.discounts
+
+        first = df[~df.index.duplicated(keep='first')]
+
+        self.supplier_discounts = pd.DataFrame({
+            'Todos': first['Codigo'] == '0',
+            '% Desc real': first['% Desc real'].astype(float),
+            'Rango': first['Rango']
+        })
+
+        products = (
+            df
+            .set_index('Codigo', append=True)
+            [['% Desc real', 'Rango']]
+            .astype({'% Desc real': float})
         )
-            .strftime('%d/%m/%Y')
-            .tolist())
+
+        duplicated = products.index.duplicated(keep='first')
+
+        if duplicated.any():
+            logging.warning(
+                f'Descuentos repetidos ignorados: '
+                f'{products.index[duplicated].to_list()}'
+            )
+
+        self.product_discounts = products[~duplicated].sort_index()
+
+    def __apply_discounts(self, df: DataFrame) -> DataFrame:
+        """
+        Real discount of every row, in one pass over the whole report
+
+        Args:
+            df (DataFrame): Report rows of the "proveedores" suppliers
+
+        Returns:
+            DataFrame: With real '% Descuento' for suppliers with discounts,
+                'Rango' (day bitmask, 0 without discount), 'En periodo' and
+                'Nota' (discount over the base price of each supplier)
+        """
+        groups = df['Grupo'].astype(object)
+        codes = df['Código'].astype(object)
+
+        suppliers = self.supplier_discounts.reindex(groups)
+        products = self.product_discounts.reindex(
+            pd.MultiIndex.from_arrays([groups, codes])
+        )
+
+        active = groups.isin(self.supplier_discounts.index).to_numpy()
+        all_products = suppliers['Todos'].fillna(False).to_numpy(dtype=bool)
+
+        # products without discount have no discount days
+        pct = np.where(
+            all_products,
+            suppliers['% Desc real'],
+            products['% Desc real'].fillna(0)  # REVISAR SI LLENAR CON CERO
+        )
+
+        date_range = np.where(
+            all_products,
+            suppliers['Rango'].fillna(0),
+            products['Rango'].fillna(0)
+        ).astype('int64')
+
+        df['% Descuento'] = df['% Descuento'].mask(active, pct)
+        df['Rango'] = np.where(active, date_range, 0)
+        df['En periodo'] = utils.in_period(df['Fecha'], df['Rango'], self.period)
+
+        # 1: 'Precio Neto', otherwise 'Costo Total'
+        mode = groups.map(self.base['Base descuento']).to_numpy()
+        base_price = df['Precio Neto'].where(mode == 1, df['Costo Total'])
+
+        df['Nota'] = base_price * df['% Descuento']
+
+        return df
+
+    def __set_layout(self, df: DataFrame) -> DataFrame:
+        """
+        Lay rows out once by (Grupo, Descripción, Fecha), with integer sort
+        keys, so supplier slices are contiguous and come in report order
+
+        Args:
+            df (DataFrame): Main dataframe
+
+        Returns:
+            DataFrame: Sorted rows with 'Orden descripción' (rank of the
+                description) and 'Orden nota' (rank by descending 'Nota',
+                ties in layout order)
+        """
+        groups = pd.factorize(df['Grupo'], sort=True)[0]
+
+        # missing descriptions last, as sort_values does
+        desc = pd.factorize(df['Descripción'], sort=True)[0]
+        desc = np.where(desc < 0, len(desc), desc)
+
+        dates = df['Fecha'].to_numpy(dtype='datetime64[ns]').view('int64')
+
+        order = np.lexsort((dates, desc, groups))
+
+        df = df.take(order).reset_index(drop=True)
+        df['Orden descripción'] = desc[order].astype('int32')
+
+        nota = df['Nota'].to_numpy(dtype=float, na_value=np.nan)
+        rank = np.empty(len(df), dtype='int64')
+        rank[np.argsort(-nota, kind='stable')] = np.arange(len(df))
+
+        df['Orden nota'] = rank
+
+        return df
 
     def get_suppliers(self) -> dict:
         """
@@ -440,25 +920,20 @@ class Preprocessing:
         """
         Main method
         """
+        if self.__prepared:
+            return
+
         # get month and year
-        d = utils.format_datetime(
-            self.data['fecha_factura'].values[0]
-        )
+        d = self.data['Fecha'].iloc[0]
 
         self.__month = d.month
         self.__year = d.year
 
-        # preprocess main data report
-        self.data = (
-            self.data
-            .pipe(self.__drop_unneeded_rows)
-            .pipe(self.__drop_unneeded_cols)
-            .pipe(self.__reset_index, False)
-            .pipe(self.__set_column_names)
-            .pipe(self.__fill_nan_numeric_cols)
-            .pipe(self.__set_dtypes)
-            .pipe(self.__include_net_prices)
-        )
+        # first day of the report, day 0 of the discount bitmasks
+        self.period = pd.Timestamp(d.year, d.month, 1)
+
+        # keep suppliers of "proveedores" file
+        self.data = self.__drop_unneeded_rows(self.data)
 
         # preprocess discounts df
         self.discounts.dropna(
@@ -470,9 +945,19 @@ class Preprocessing:
             self.discounts.apply(
                 self._create_date_ranges,
                 axis=1
-        )
+        ).astype('int64')
 
         self.discounts.drop(
             columns=['Fecha', 'Descripción'],
             inplace=True
         )
+
+        self.__compile_discounts()
+
+        self.data = (
+            self.data
+            .pipe(self.__apply_discounts)
+            .pipe(self.__set_layout)
+        )
+
+        self.__write_prepared()
@@ -1,9 +1,18 @@
+import re
+import os
+import json
+import hashlib
 import logging
-from server.excel import XlsxWriterEditor
+from contextlib import contextmanager
+from functools import wraps
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from xlsxwriter import Workbook
+from server.excel import XlsxWriterEditor, ExcelWriterPool
+import server.allocation as allocation
+import numpy as np
 import pandas as pd
 from pandas.core.frame import DataFrame
-import copy
-import random
 from server.preprocess import Preprocessing
 
 logging.basicConfig(filename='app.log',
@@ -11,6 +20,44 @@ logging.basicConfig(filename='app.log',
                     datefmt='%d-%b-%y %H:%M:%S')
 
 
+def _copy_on_write(method):
+    """
+    Run the method with copy-on-write, so supplier slices are views of the
+    data copied only when a column is modified (the default from pandas 3).
+    The option is restored on return, pandas is not changed process-wide.
+    """
+    if int(pd.__version__.split('.')[0]) >= 3:
+        return method
+
+    @wraps(method)
+    def wrapper(*args, **kwargs):
+        with pd.option_context('mode.copy_on_write', True):
+            return method(*args, **kwargs)
+
+    return wrapper
+
+
+# report copy of each worker process (parallel run)
+_worker_report = None
+
+
+def _init_worker(report) -> None:
+    global _worker_report
+    _worker_report = report
+
+
+@_copy_on_write
+def _process_supplier(
+        supplier: str,
+        use_mode: bool,
+        include_reports: bool) -> tuple:
+    return _worker_report._process_supplier(
+        supplier,
+        use_mode,
+        include_reports
+    )
+
+
 class EmesReport:
 
     PRICES = [
@@ -43,10 +90,17 @@ class EmesReport:
         'Diferencia real %',
     ]
 
+    # keys of the saved workbooks, in path_to
+    MANIFEST = 'manifest.json'
+
+    # bump when the sheets built from the same inputs change
+    REPORT_VERSION = 2
+
     def __init__(self,
                  path_grid: str,
                  path_to: str,
-                 path_groups: str):
+                 path_groups: str,
+                 streaming: bool = False):
 
         # set path to save reports
         self.__path_to = path_to
@@ -54,33 +108,70 @@ class EmesReport:
         # create use dataframe
         self.__df_use = None
 
+        # background workbook writers, active during a sequential run
+        self.__writer = None
+
+        # column widths of the supplier sheets, kept between runs and
+        # merged back from the worker processes
+        self.__widths = {}
+
+        # write workbooks row by row in constant_memory mode
+        self.__constant_memory = False
+
+        # sheet writer of the single workbook, if the run writes one file
+        self.__book = None
+        self.__single_file = False
+        self.__sheet_names = set()
+
+        # skip suppliers whose inputs did not change since the saved workbook
+        self.__skip_unchanged = False
+        self.__manifest = {}
+        self.__joined_keys = []
+
         # create Preprocessing object
         p = Preprocessing(
             path_grid,
-            path_groups
+            path_groups,
+            streaming
         )
 
         p.run()
 
         self.__df_base = p.base
         self.__df_discounts = p.discounts
+        self.__supplier_discounts = p.supplier_discounts
+        self.__product_discounts = p.product_discounts
+        # laid out by (Grupo, Descripción, Fecha) in preprocessing
         self.__data = p.data
+        self.__partition = self.__get_partition(self.__data)
+
+        # reallocated rows of each supplier, planned at the start of a run
+        self.__reallocated = {}
+        self.__strategy = 'greedy'
+        self.__period = p.period
         self.__suppliers = p.get_suppliers()
         self.__active_suppliers = \
             [k for k, v in self.__suppliers.items() if v]
 
-        # create summary report dataframe
-        self.__df_summ = pd.DataFrame(
-            columns=EmesReport.SUMMARY_COLS
-        )
-
-        self.__df_summ.index.names = ['Proveedor']
+        # summary records, format {"name": {"col": value}}, turned into
+        # the summary dataframe on demand
+        self.__summary = {}
 
         # create joined dataframes from special case (Tecnoquímicas)
         self.__df1_joined, self.__df2_joined = (
             pd.DataFrame() for _ in range(2)
         )
 
+    def __getstate__(self) -> dict:
+        """
+        Copy sent to worker processes, without writer threads or workbook
+        """
+        state = self.__dict__.copy()
+        state['_EmesReport__writer'] = None
+        state['_EmesReport__book'] = None
+
+        return state
+
     @property
     def data(self) -> DataFrame:
         return self.__data
@@ -95,7 +186,15 @@ class EmesReport:
 
     @property
     def summary(self) -> DataFrame:
-        return self.__df_summ
+        df = pd.DataFrame.from_dict(
+            self.__summary,
+            orient='index',
+            columns=EmesReport.SUMMARY_COLS
+        )
+
+        df.index.name = 'Proveedor'
+
+        return df
 
     @property
     def use(self) -> DataFrame:
@@ -112,6 +211,37 @@ class EmesReport:
     def get_suppliers(self) -> list:
         return self.__df_base.index.to_list()
 
+    def __get_partition(self, df: DataFrame) -> dict:
+        """
+        Args:
+            df (DataFrame): Data sorted by 'Grupo'
+
+        Returns:
+            dict: Format {"name": (start, stop)} row offsets of each supplier
+        """
+        groups = df['Grupo'].to_numpy()
+
+        bounds = np.flatnonzero(groups[1:] != groups[:-1]) + 1
+        starts = np.concatenate([[0], bounds]) if len(groups) else bounds
+        stops = np.append(bounds, len(groups))
+
+        return {
+            groups[start]: (start, stop)
+            for start, stop in zip(starts, stops)
+        }
+
+    def __get_supplier_data(self, name: str) -> DataFrame:
+        """
+        Args:
+            name (str): Supplier name
+
+        Returns:
+            DataFrame: Rows of the supplier, sliced without copying
+        """
+        start, stop = self.__partition.get(name, (0, 0))
+
+        return self.__data.iloc[start:stop]
+
     def __get_use_value_by_type(
             self,
             base: float,
@@ -136,16 +266,6 @@ class EmesReport:
 
         return val, use
 
-    def __select_all_products(self, name: str) -> bool:
-        """
-        Args:
-            name (str): Supplier name
-
-        Returns:
-            bool: True if same discount apply for all products
-        """
-        return self.__df_discounts.loc[name, 'Codigo'][0] == '0'
-
     def __remove_bonus_rows(self, df: DataFrame) -> DataFrame:
         """
         Remove rows with 'Bonificados'
@@ -164,110 +284,141 @@ class EmesReport:
     def __select_by_date_range(
             self,
             df: DataFrame,
-            name: str) -> tuple[DataFrame, DataFrame]:
+            name: str) -> DataFrame:
         """
         Args:
-            df (DataFrame): Dataframe with 'Fecha' column
+            df (DataFrame): Dataframe with 'En periodo' column
             name (str): Supplier name
 
         Returns:
-            tuple: (df) [In-period, Out-of-period]
+            DataFrame: In-period rows
         """
         if self.__suppliers[name]:
-            df_ss = self.__df_discounts.query('Proveedor == @name')
-
-            if self.__select_all_products(name):
-                mask = df['Fecha'].isin(df_ss['Rango'].values[0])
-            else:
-                code_range = df_ss.set_index('Codigo').to_dict()['Rango']
-
-                mask = df.apply(
-                    lambda x: any(y == x['Fecha']
-                                  for y in code_range.get(x['Código'], [])),
-                    axis=1
-                )
-
             # delete all the product with bonus
-            df_in = df[mask]
+            df_in = df[df['En periodo'].to_numpy()]
             df_in = self.__remove_bonus_rows(df_in)
 
-            df_out = df[~mask].sort_values(by=['Nota'], ascending=False)
-            df_out = self.__remove_bonus_rows(df_out)
-
-            return df_in, df_out
+            return df_in
         else:
-            return df, None
+            return df
 
-    def __reallocate_discounts(
-            self,
-            df_in: DataFrame,
-            df_out: DataFrame,
-            discount_diff: float,
-            base_price: str,
-            use_value: float) -> DataFrame:
+    def __get_use_value(self, name: str) -> float:
         """
         Args:
-            df_in (DataFrame): Discount period
-            df_out (DataFrame): Non-discount period
-            discount_diff (float): Max diff allowed
-            base_price (str): Base discount price column
-            use_value (float): 'Aprovechamiento'
+            name (str): Supplier name
 
         Returns:
-            DataFrame: Contains data with the addition of discount
+            float: 'Aprovechamiento' of the supplier, 0 if not set
         """
-        if df_out is not None and not df_out.empty:
-            total_diff, _ = self.__get_use_value_by_type(
-                discount_diff,
-                use_value
-            )
+        if self.__df_use is None or name not in self.__df_use.index:
+            return 0
 
-            # falculate the discount value
-            discount_value = df_out[base_price] * df_out['% Descuento']
+        return self.__df_use.loc[name, 'Aprovechamiento']
 
-            # add '% Descuento', 'Nota' and 'Fecha' columns
-            df_out['Nota'] = discount_value
+    def __plan_reallocation(self, suppliers: list) -> dict:
+        """
+        Out-of-period rows added to the discount period of every requested
+        supplier whose real discount is below the 260 report discount, in
+        one pass over the data
 
-            # prepare data
-            df_out = (
-                df_out
-                .sort_values(by=['Nota'], ascending=False)
-                .reset_index(drop=True)
-            )
+        Args:
+            suppliers (list): suppliers of the run
+
+        Returns:
+            dict: Format {"name": rows} row offsets within the supplier,
+                by descending 'Nota'
+        """
+        df = self.__data
+
+        names = list(self.__partition)
+        bounds = np.array(
+            [start for start, _ in self.__partition.values()] + [len(df)]
+        )
+        supplier = np.repeat(np.arange(len(names)), np.diff(bounds))
+
+        active = df['Grupo'].isin(self.__active_suppliers).to_numpy()
+        in_period = df['En periodo'].to_numpy()
+
+        bonus = (
+            (df['Subgrupo'] == 'Bonificados') |
+            df['Código'].str.endswith('BOF')
+        ).to_numpy(dtype=bool, na_value=False)
+
+        notes = df['Nota'].to_numpy(dtype=float, na_value=np.nan)
+
+        # real discount vs 260 discount report
+        sum_discount = np.bincount(
+            supplier,
+            weights=(
+                df['Valor descuento'].to_numpy(dtype=float, na_value=np.nan) *
+                df['Cantidad'].to_numpy(dtype=float, na_value=np.nan)
+            ),
+            minlength=len(names)
+        )
 
-            # cumulative discounts column
-            df_out['cumsum'] = df_out['Nota'].cumsum()
+        sum_notes = np.bincount(
+            supplier[in_period & ~bonus],
+            weights=notes[in_period & ~bonus],
+            minlength=len(names)
+        )
 
-            # select next value to condition if exists
-            match_list = df_out.index[df_out['cumsum'] <= total_diff].tolist()
+        totals = np.full(len(names), np.nan)
 
-            if match_list:
-                if match_list[-1] + 2 > df_out.shape[0]:
-                    df_out = df_out.query('cumsum <= @total_diff')
-                else:
-                    df_out = df_out.iloc[:match_list[-1] + 2]
+        for i, name in enumerate(names):
+            discount_diff = sum_discount[i] - sum_notes[i]
 
-                # includes the next where condition is reached
-                df_out = df_out.query('`% Descuento` >= 0')
+            if name not in self.__active_suppliers or \
+                    name not in suppliers or not discount_diff > 0:
+                continue
 
-                # append the new rows to df_in
-                df_in = pd.concat(
-                    [
-                        df_in,
-                        df_out
-                    ],
-                    ignore_index=True
+            try:
+                totals[i], _ = self.__get_use_value_by_type(
+                    discount_diff,
+                    self.__get_use_value(name)
+                )
+            except Exception as e:
+                logging.error(
+                    f'Exception {e} occurred in supplier {name}',
+                    exc_info=True
                 )
 
-        return df_in
+        valid = df['% Descuento'].to_numpy(dtype=float, na_value=np.nan) >= 0
+
+        # out-of-period rows by supplier, then descending 'Nota'; the
+        # greedy rule counts rows with negative discount, the others skip them
+        candidates = active & ~in_period & ~bonus
+
+        if self.__strategy != 'greedy':
+            candidates &= valid
+
+        rows = np.flatnonzero(candidates)
+        rows = rows[np.lexsort((
+            df['Orden nota'].to_numpy()[rows],
+            supplier[rows]
+        ))]
+
+        offsets = np.searchsorted(supplier[rows], np.arange(len(names) + 1))
+
+        selected = allocation.STRATEGIES[self.__strategy](
+            notes[rows],
+            offsets,
+            totals
+        )
+
+        selected &= valid[rows]
+
+        return {
+            name: rows[start:stop][selected[start:stop]] - bounds[i]
+            for i, (name, start, stop)
+            in enumerate(zip(names, offsets[:-1], offsets[1:]))
+            if selected[start:stop].any()
+        }
 
     def _set_sheet1(self, df: DataFrame) -> DataFrame:
         """
         Set 'Rotacion' sheet features
         """
-        df_out = copy.deepcopy(df)
-
-        return df_out.drop(
+        return df.drop(
             [
                 "% Descuento",
                 "Nota"
@@ -275,57 +426,6 @@ class EmesReport:
             axis='columns'
         )
 
-    def __get_note_discounts(
-            self,
-            df: DataFrame,
-            name: str,
-            base_price: str) -> DataFrame:
-        """
-        Calculates Nota (real discount)
-
-        Args:
-            df (DataFrame): Supplier dafaframe
-            name (str): Supplier name
-            base_price (str): Base price column
-
-        Returns:
-            DataFrame: Contains added 'Nota' column
-        """
-        if name in self.__active_suppliers:
-            df_ss = self.__df_discounts[self.__df_discounts.index == name]
-
-            if self.__select_all_products(name):
-                df['% Descuento'] = float(df_ss['% Desc real'].values[0])
-                df['Rango'] = [
-                    df_ss['Rango'].values[0] for _ in range(df.shape[0])
-                ]
-            else:
-                df = df.merge(
-                    df_ss,
-                    left_on='Código',
-                    right_on='Codigo',
-                    how='left'
-                )
-
-                df['% Descuento'] = df['% Desc real'].fillna(
-                    value=0  # df['% Descuento']  # REVISAR SI LLENAR CON CERO
-                )
-
-                values = random.choice(
-                    df['Rango'].dropna().tolist()
-                )
-
-                df['Rango'] = [
-                    values if not isinstance(x, list) else x
-                    for x in df['Rango']
-                ]
-
-                df = df.drop(columns=['Codigo', '% Desc real'])
-
-        df["Nota"] = df[base_price] * df["% Descuento"]
-
-        return df
-
     def __remove_columns_by_mode(
             self,
             df: DataFrame,
@@ -344,30 +444,21 @@ class EmesReport:
         return \
             df.drop(cols_to_drop, axis='columns') if cols_to_drop else df
 
-    def __sort_by_date(self, df: DataFrame) -> DataFrame:
-        """
-        Args:
-            df (DataFrame): Dataframe to sort
-
-        Returns:
-            DataFrame: Sorted dataframe
-        """
-        return df.sort_values(
-            by=['Fecha']
-        )
-
     def __sort_by_description(self, df: DataFrame) -> DataFrame:
         """
         Args:
             df (DataFrame): Dataframe to sort
 
         Returns:
-            DataFrame: Sorted dataframe by description
+            DataFrame: Sorted dataframe by description, then date
         """
-        return df.sort_values(
-            by=['Descripción']
+        order = np.argsort(
+            df['Orden descripción'].to_numpy(),
+            kind='stable'
         )
 
+        return df.take(order)
+
     def __get_discount_diff(
             self,
             df_all: DataFrame,
@@ -433,15 +524,11 @@ class EmesReport:
         Returns
             DataFrame: Sorted dataframe.
         """
-        loc = df.columns.get_loc('% Descuento') + 1
-
-        df.insert(
-            loc=loc,
-            column='Nota',
-            value=df.pop('Nota')
-        )
+        cols = df.columns.drop('Nota')
+        loc = cols.get_loc('% Descuento') + 1
 
-        return df
+        # column projection, no data is copied
+        return df[cols.insert(loc, 'Nota')]
 
     def __reset_index(self, df: DataFrame, drop: bool) -> DataFrame:
         """
@@ -469,42 +556,32 @@ class EmesReport:
         """
         base_price = 'Precio Neto' if mode == 1 else 'Costo Total'
 
-        df_all = copy.deepcopy(df)
-
+        # df is a view of the data, each step returns a new frame
         df_all = (
-            df_all
-            .pipe(self.__get_note_discounts, name, base_price)
+            df
             .pipe(self.__remove_columns_by_mode, mode)
-            .pipe(self.__sort_by_date)
             .pipe(self.__reorder_cols)
         )
 
-        df_in, df_out = self.__select_by_date_range(
+        df_in = self.__select_by_date_range(
             df_all,
             name
         )
 
         # compare real discount vs 260 discount report
-        discount_diff, sum_discount, sum_notes = self.__get_discount_diff(
+        _, sum_discount, sum_notes = self.__get_discount_diff(
             df_all,
             df_in
         )
 
-        if discount_diff > 0:
-            if self.__df_use is None:
-                use_value = 0
-            else:
-                if name in self.__df_use.index:
-                    use_value = self.__df_use.loc[name, 'Aprovechamiento']
-                else:
-                    use_value = 0
-
-            df_in = self.__reallocate_discounts(
-                df_in,
-                df_out,
-                discount_diff,
-                base_price,
-                use_value
+        # append the reallocated rows, planned for every supplier at once
+        if name in self.__reallocated:
+            df_in = pd.concat(
+                [
+                    df_in,
+                    df_all.take(self.__reallocated[name])
+                ],
+                ignore_index=True
             )
 
         # delete rows with discount less than zero and negative prices
@@ -526,12 +603,12 @@ class EmesReport:
         )
 
         return (
-            df_all.pipe(self.__drop_unneeded_cols)
-                  .pipe(self.__reset_index, True)
-                  .pipe(self.__sort_by_description),
-            df_in.pipe(self.__drop_unneeded_cols)
+            df_all.pipe(self.__sort_by_description)
+                  .pipe(self.__drop_unneeded_cols)
+                  .pipe(self.__reset_index, True),
+            df_in.pipe(self.__sort_by_description)
+                 .pipe(self.__drop_unneeded_cols)
                  .pipe(self.__reset_index, True)
-                 .pipe(self.__sort_by_description)
         )
 
     def __fill_summary(
@@ -544,20 +621,38 @@ class EmesReport:
         """
         Fill report summary
         """
+        record = self.__get_record(name)
+
         if not use_mode:
-            self.__df_summ.loc[name, 'Descuento sistema'] = sum_discount
-            self.__df_summ.loc[name, 'Descuento feria'] = sum_notes
+            record['Descuento sistema'] = float(sum_discount)
+            record['Descuento feria'] = float(sum_notes)
 
             diff_note = sum_notes - sum_discount
-            self.__df_summ.loc[name, 'Diferencia feria $'] = diff_note
+            record['Diferencia feria $'] = float(diff_note)
         else:
-            self.__df_summ.loc[name, 'Descuento real'] = sum_real_discount
+            record['Descuento real'] = float(sum_real_discount)
 
             diff_real = sum_real_discount - sum_discount
-            self.__df_summ.loc[name, 'Diferencia real $'] = diff_real
+            record['Diferencia real $'] = float(diff_real)
 
             temp = diff_real / sum_discount if sum_discount != 0.0 else 0.0
-            self.__df_summ.loc[name, 'Diferencia real %'] = temp
+            record['Diferencia real %'] = float(temp)
+
+    def __get_record(self, name: str) -> dict:
+        """
+        Args:
+            name (str): Supplier name
+
+        Returns:
+            dict: Summary record of the supplier, NaN until filled
+        """
+        if name not in self.__summary:
+            self.__summary[name] = dict.fromkeys(
+                EmesReport.SUMMARY_COLS,
+                np.nan
+            )
+
+        return self.__summary[name]
 
     def __join_to_data(
             self,
@@ -590,6 +685,35 @@ class EmesReport:
             df (DataFrame): dataframe subset
         """
         name = df.iloc[0, 0]
+        key = self.__get_report_key(name, df, use_mode)
+
+        if self.__restore_unchanged(name, key, use_mode):
+            return
+
+        name, df_sheet1, df_sheet2 = self._build_sheets(df, use_mode)
+
+        self._save_sheets(
+            name,
+            df_sheet1,
+            df_sheet2,
+            use_mode,
+            include_reports,
+            key
+        )
+
+    def _build_sheets(
+            self,
+            df: DataFrame,
+            use_mode: bool) -> tuple[str, DataFrame, DataFrame]:
+        """
+        Args:
+            df (DataFrame): dataframe subset
+            use_mode (bool): True if 'Aprovechamiento' is incorporated
+
+        Returns:
+            tuple: (name, df 'Rotación', df 'Teleferias')
+        """
+        name = df.iloc[0, 0]
 
         mode = self.__df_base.loc[name, 'Base descuento']
 
@@ -604,21 +728,44 @@ class EmesReport:
         # get Rotacion sheet
         df_sheet1 = self._set_sheet1(df2)
 
+        return name, df_sheet1, df_sheet2
+
+    def _save_sheets(
+            self,
+            name: str,
+            df_sheet1: DataFrame,
+            df_sheet2: DataFrame,
+            use_mode: bool,
+            include_reports: bool,
+            key: str = None) -> None:
+        """
+        Args:
+            name (str): supplier name
+            df_sheet1 (DataFrame): 'Rotación' sheet
+            df_sheet2 (DataFrame): 'Teleferia' sheet
+            use_mode (bool): true if is Teleferia file
+            include_reports (bool): true if save previous reports into Excel file
+            key (str, optional): report key of the supplier inputs
+        """
         # join dataframe for joined suppliers case
         if name in EmesReport.JOINED_SUPPLIERS:
             self.__join_to_data(df_sheet1, 1)
             self.__join_to_data(df_sheet2, 2)
+            self.__joined_keys.append(key)
 
             if name in EmesReport.JOINED_SUPPLIERS[:3]:
                 return
 
+            key = self.__join_report_keys(self.__joined_keys)
+
+            if self.__get_entry('248-TECNOQUIMICAS', key, use_mode):
+                return
+
             # if last supplier of list
             df_sheet1 = self.__df1_joined.\
-                sort_values(by='Descripción').\
-                copy()
+                sort_values(by='Descripción', kind='stable')
             df_sheet2 = self.__df2_joined.\
-                sort_values(by='Descripción').\
-                copy()
+                sort_values(by='Descripción', kind='stable')
 
             name = '248-TECNOQUIMICAS'
 
@@ -628,38 +775,126 @@ class EmesReport:
             df_sheet1,
             df_sheet2,
             use_mode,
-            include_reports
+            include_reports,
+            self.__new_entry(name, key, use_mode)
         )
 
+    def _process_supplier(
+            self,
+            supplier: str,
+            use_mode: bool,
+            include_reports: bool) -> tuple:
+        """
+        Process one supplier inside a worker process. Joined suppliers, and
+        every supplier of a single file run, are returned to the main
+        process instead of saved.
+
+        Returns:
+            tuple: (name, summary row, (df 'Rotación', df 'Teleferias') or
+                None, report key, manifest entry of the saved workbook,
+                column widths measured for the supplier)
+        """
+        try:
+            df_ss = self.__get_supplier_data(supplier)
+            name = df_ss.iloc[0, 0]
+            key = self.__get_report_key(name, df_ss, use_mode)
+
+            if self.__restore_unchanged(name, key, use_mode):
+                return name, dict(self.__get_record(name)), None, key, None, {}
+
+            name, df_sheet1, df_sheet2 = self._build_sheets(df_ss, use_mode)
+            summary = dict(self.__get_record(name))
+
+        except Exception as e:
+            logging.error(
+                f'Exception {e} occurred in supplier {supplier}',
+                exc_info=True
+            )
+
+            return None
+
+        if name in EmesReport.JOINED_SUPPLIERS or self.__single_file:
+            return name, summary, (df_sheet1, df_sheet2), key, None, {}
+
+        entry = self.__new_entry(name, key, use_mode)
+
+        try:
+            self.__to_excel(
+                name,
+                df_sheet1,
+                df_sheet2,
+                use_mode,
+                include_reports
+            )
+        except Exception as e:
+            logging.error(
+                f'Exception {e} occurred in supplier {supplier}',
+                exc_info=True
+            )
+
+            entry = None
+
+        widths = {
+            cache_key: width
+            for cache_key, width in self.__widths.items()
+            if cache_key[0][0] == name
+        }
+
+        return name, summary, None, key, entry, widths
+
     def __summary_to_excel(self) -> None:
         """
         Save summary into Excel
         """
         path = self.__path_to + f'\\Resumen.xlsx'
 
-        with pd.ExcelWriter(path, engine='xlsxwriter') as writer:
-            xlsx = XlsxWriterEditor(writer.book)
+        df = self.summary
 
-            mask = self.__df_summ['Proveedor'].isin(
-                self.__active_suppliers)
+        df_ss = df[df.index.isin(self.__active_suppliers)].reset_index()
 
-            df_ss = self.__df_summ[mask]
+        if self.__book is not None:
+            self.__write_summary(self.__book, df_ss)
+        else:
+            with self.__open_workbook(path) as write:
+                self.__write_summary(write, df_ss)
 
-            df_ss.to_excel(
-                writer,
-                sheet_name='Resumen',
-                engine='xlsxwriter',
-                index=False
-            )
+    def __write_summary(self, write, df: DataFrame) -> None:
+        """
+        Args:
+            write (callable): sheet writer of the workbook
+            df (DataFrame): summary of the active suppliers
+        """
+        write(
+            df=df,
+            sheet='Resumen',
+            prices_cols=EmesReport.SUMMARY_COLS[:5],
+            left_align_cols=['Proveedor'],
+            perc_cols=['Diferencia real %'],
+            include_sum=True
+        )
 
-            xlsx.format_worksheet(
-                df=df_ss,
-                worksheet=writer.sheets['Resumen'],
-                prices_cols=EmesReport.SUMMARY_COLS[:5],
-                left_align_cols=['Proveedor'],
-                perc_cols=['Diferencia real %'],
-                include_sum=True
-            )
+    @contextmanager
+    def __open_workbook(self, path: str):
+        """
+        Open an Excel file and yield a function that writes a dataframe
+        as a formatted sheet, straight from its column arrays
+
+        Args:
+            path (str): Excel file path
+        """
+        options = {'constant_memory': self.__constant_memory}
+
+        with Workbook(path, options) as wb:
+            xlsx = XlsxWriterEditor(wb, self.__widths)
+
+            def write(df: DataFrame, sheet: str, **kwargs) -> None:
+                xlsx.write_worksheet(
+                    df=df,
+                    worksheet=wb.add_worksheet(sheet),
+                    **kwargs
+                )
+
+            yield write
 
     def __to_excel(
             self,
@@ -667,7 +902,8 @@ class EmesReport:
             df1: DataFrame,
             df2: DataFrame,
             use_mode: bool,
-            include_reports: bool) -> None:
+            include_reports: bool,
+            entry: dict = None) -> None:
         """
         Function to save dataframes into Excel file
 
@@ -677,57 +913,330 @@ class EmesReport:
             df2 (DataFrame): sheet 2 dataframe
             use_mode (bool): true if is Teleferia file
             include_reports (bool): true if save previous reports into Excel file
+            entry (dict, optional): manifest entry recorded once saved
         """
         if not use_mode and not include_reports:
             return
 
+        if self.__book is not None:
+            self.__write_sheets(self.__book, name, df1, df2, True)
+            return
+
+        file_path = self.__get_file_path(name, use_mode)
+
+        if self.__writer is not None:
+            self.__writer.submit(file_path, name, df1, df2, entry)
+        else:
+            self.__write_excel(file_path, name, df1, df2, entry)
+
+    def __write_excel(
+            self,
+            file_path: str,
+            name: str,
+            df1: DataFrame,
+            df2: DataFrame,
+            entry: dict = None) -> None:
+        """
+        Write supplier sheets into an Excel file
+
+        Args:
+            file_path (str): Excel file path
+            name (str): supplier name
+            df1 (DataFrame): sheet 1 dataframe
+            df2 (DataFrame): sheet 2 dataframe
+            entry (dict, optional): manifest entry recorded once saved
+        """
+        with self.__open_workbook(file_path) as write:
+            self.__write_sheets(write, name, df1, df2)
+
+        if entry is not None:
+            self.__manifest.update(entry)
+
+    def __get_file_name(self, name: str, use_mode: bool) -> str:
+        """
+        Returns:
+            str: Workbook name of the supplier, without extension
+        """
         file_suffix = '' if use_mode else '_prev'
-        file_path = self.__path_to + f'\\{name}{file_suffix}.xlsx'
 
-        with pd.ExcelWriter(file_path,
-                            engine='xlsxwriter') as writer:
-            xlsx = XlsxWriterEditor(writer.book)
+        return f'{name}{file_suffix}'
+
+    def __get_file_path(self, name: str, use_mode: bool) -> str:
+        """
+        Returns:
+            str: Workbook path of the supplier
+        """
+        return self.__path_to + f'\\{self.__get_file_name(name, use_mode)}.xlsx'
+
+    def __get_report_key(
+            self,
+            name: str,
+            df: DataFrame,
+            use_mode: bool) -> str:
+        """
+        Hash of everything the supplier workbook is built from: its rows,
+        'Base' and 'Descuentos' rows, use value, mode and period
+
+        Args:
+            name (str): supplier name
+            df (DataFrame): supplier rows
+            use_mode (bool): True if 'Aprovechamiento' is incorporated
+
+        Returns:
+            str: Report key, None if unchanged reports are not skipped
+        """
+        if not self.__skip_unchanged:
+            return None
+
+        digest = hashlib.blake2b(digest_size=16)
 
-            df1.to_excel(
-                writer,
-                sheet_name='Rotación',
-                engine='xlsxwriter',
-                index=False
+        digest.update(
+            f'{EmesReport.REPORT_VERSION}|{name}|{use_mode}|'
+            f'{self.__period}|{self.__suppliers.get(name)}|'
+            f'{self.__strategy}'.encode()
+        )
+
+        # month-wide layout ranks change with other suppliers' rows, the
+        # order within the supplier follows from its own values
+        frames = [
+            df.drop(columns=['Orden descripción', 'Orden nota']),
+            self.__df_base.loc[[name]],
+            self.__supplier_discounts[
+                self.__supplier_discounts.index == name
+            ],
+            self.__product_discounts[
+                self.__product_discounts.index.get_level_values(0) == name
+            ]
+        ]
+
+        if self.__df_use is not None and name in self.__df_use.index:
+            frames.append(self.__df_use.loc[[name]])
+
+        for frame in frames:
+            digest.update('|'.join(map(str, frame.columns)).encode())
+            digest.update(
+                pd.util.hash_pandas_object(frame, index=False)
+                .to_numpy()
+                .tobytes()
             )
 
-            # edit worksheet
-            xlsx.format_worksheet(
-                df=df1,
-                worksheet=writer.sheets['Rotación'],
-                prices_cols=EmesReport.PRICES,
-                left_align_cols=EmesReport.LEFT_ALIGN
+        return digest.hexdigest()
+
+    @staticmethod
+    def __join_report_keys(keys: list) -> str:
+        """
+        Returns:
+            str: Report key of the joined suppliers, None if any is missing
+        """
+        if not keys or None in keys:
+            return None
+
+        return hashlib.blake2b(
+            '|'.join(keys).encode(),
+            digest_size=16
+        ).hexdigest()
+
+    def __get_entry(self, name: str, key: str, use_mode: bool) -> dict:
+        """
+        Returns:
+            dict: Manifest entry of the supplier if its workbook was saved
+                from the same key and still exists, None otherwise
+        """
+        if key is None or not self.__skip_unchanged:
+            return None
+
+        entry = self.__manifest.get(self.__get_file_name(name, use_mode))
+
+        if entry is None or entry['key'] != key:
+            return None
+
+        if not os.path.exists(self.__get_file_path(name, use_mode)):
+            return None
+
+        return entry
+
+    def __restore_unchanged(self, name: str, key: str, use_mode: bool) -> bool:
+        """
+        Fill the summary of an unchanged supplier from the manifest, so its
+        workbook is neither built nor saved again
+
+        Returns:
+            bool: True if the supplier is unchanged
+        """
+        if name in EmesReport.JOINED_SUPPLIERS:
+            return False
+
+        entry = self.__get_entry(name, key, use_mode)
+
+        if entry is None:
+            return False
+
+        self.__get_record(name).update(entry['summary'])
+
+        return True
+
+    def __new_entry(self, name: str, key: str, use_mode: bool) -> dict:
+        """
+        Returns:
+            dict: Format {"file name": {"key": key, "summary": row}}, None
+                if there is no key or unchanged reports are not skipped
+        """
+        if key is None or not self.__skip_unchanged:
+            return None
+
+        cols = EmesReport.SUMMARY_COLS[3:] if use_mode \
+            else EmesReport.SUMMARY_COLS[:3]
+
+        record = self.__get_record(name)
+
+        summary = {
+            col: record[col]
+            for col in cols
+        }
+
+        return {
+            self.__get_file_name(name, use_mode): {
+                'key': key,
+                'summary': summary
+            }
+        }
+
+    def __load_manifest(self) -> None:
+        """
+        Read the keys of the saved workbooks
+        """
+        path = self.__path_to + f'\\{EmesReport.MANIFEST}'
+
+        try:
+            with open(path, encoding='utf-8') as f:
+                self.__manifest = json.load(f)
+        except FileNotFoundError:
+            self.__manifest = {}
+        except Exception as e:
+            logging.error(
+                f'Exception {e} occurred reading {path}',
+                exc_info=True
             )
 
-            if name in self.__active_suppliers:
-                if name != '134-COASPHARMA':
-                    df2.to_excel(
-                        writer,
-                        sheet_name='Teleferia',
-                        engine='xlsxwriter',
-                        index=False
-                    )
+            self.__manifest = {}
 
-                    # edit worksheet
-                    xlsx.format_worksheet(
-                        df=df2,
-                        worksheet=writer.sheets['Teleferia'],
-                        prices_cols=EmesReport.PRICES,
-                        left_align_cols=EmesReport.LEFT_ALIGN,
-                        perc_cols=['% Descuento'],
-                        include_sum=True
-                    )
+    def __save_manifest(self) -> None:
+        """
+        Save the keys of the saved workbooks
+        """
+        path = self.__path_to + f'\\{EmesReport.MANIFEST}'
+
+        try:
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(self.__manifest, f, indent=2)
+        except Exception as e:
+            logging.error(
+                f'Exception {e} occurred writing {path}',
+                exc_info=True
+            )
+
+    def __write_sheets(
+            self,
+            write,
+            name: str,
+            df1: DataFrame,
+            df2: DataFrame,
+            prefix: bool = False) -> None:
+        """
+        Args:
+            write (callable): sheet writer of the workbook
+            name (str): supplier name
+            df1 (DataFrame): sheet 1 dataframe
+            df2 (DataFrame): sheet 2 dataframe
+            prefix (bool): prefix sheet names with the supplier name
+        """
+        write(
+            df=df1,
+            sheet=self.__get_sheet_name(name, 'Rotación', prefix),
+            prices_cols=EmesReport.PRICES,
+            left_align_cols=EmesReport.LEFT_ALIGN,
+            key=(name, 'Rotación')
+        )
+
+        if name in self.__active_suppliers:
+            if name != '134-COASPHARMA':
+                write(
+                    df=df2,
+                    sheet=self.__get_sheet_name(name, 'Teleferia', prefix),
+                    prices_cols=EmesReport.PRICES,
+                    left_align_cols=EmesReport.LEFT_ALIGN,
+                    perc_cols=['% Descuento'],
+                    include_sum=True,
+                    key=(name, 'Teleferia')
+                )
+
+    def __get_sheet_name(self, name: str, sheet: str, prefix: bool) -> str:
+        """
+        Args:
+            name (str): supplier name
+            sheet (str): sheet name
+            prefix (bool): prefix sheet name with the supplier name
+
+        Returns:
+            str: Valid Excel sheet name (31 characters at most)
+        """
+        if not prefix:
+            return sheet
+
+        suffix = f' - {sheet[:3]}'
+        name = re.sub(r'[\[\]:*?/\\]', '', name)[:31 - len(suffix)]
+
+        # truncated names may collide, Excel compares them ignoring case
+        sheet_name, n = name + suffix, 1
+
+        while sheet_name.lower() in self.__sheet_names:
+            n += 1
+            sheet_name = f'{name[:31 - len(suffix) - len(str(n))]}{n}{suffix}'
+
+        self.__sheet_names.add(sheet_name.lower())
+
+        return sheet_name
+
+    @contextmanager
+    def __open_book(
+            self,
+            single_file: bool,
+            use_mode: bool,
+            include_reports: bool):
+        """
+        Open the workbook shared by every supplier and the summary when
+        the run writes a single file
+        """
+        if not single_file or (not use_mode and not include_reports):
+            yield
+            return
+
+        file_suffix = '' if use_mode else '_prev'
+        path = self.__path_to + f'\\Reportes{file_suffix}.xlsx'
+
+        with self.__open_workbook(path) as write:
+            self.__book = write
+            self.__single_file = True
+            self.__sheet_names = {'resumen'}
+
+            try:
+                yield
+            finally:
+                self.__book = None
+                self.__single_file = False
 
     def include_use(
             self,
             suppliers: list,
-            use_dict: dict) -> None:
+            use_dict: dict,
+            **kwargs) -> None:
         """
         Function to include Use
+
+        Args:
+            suppliers (list): suppliers to process, all if empty
+            use_dict (dict): Format {"name": use}
+            **kwargs: other options of run, e.g. strategy or workers
         """
         df = pd.DataFrame(
             data=use_dict.values(),
@@ -741,39 +1250,153 @@ class EmesReport:
         self.run(
             suppliers,
             use_mode=True,
-            include_reports=True
+            include_reports=True,
+            **kwargs
         )
 
+    def __run_parallel(
+            self,
+            suppliers: list,
+            use_mode: bool,
+            include_reports: bool,
+            workers: int) -> None:
+        """
+        Fan suppliers out to a process pool and merge their summary rows
+        and joined sheets in supplier order, as the sequential run does
+        """
+        with ProcessPoolExecutor(
+                max_workers=min(workers, len(suppliers)),
+                initializer=_init_worker,
+                initargs=(self,)) as pool:
+
+            results = pool.map(
+                _process_supplier,
+                suppliers,
+                repeat(use_mode),
+                repeat(include_reports)
+            )
+
+            for supplier, result in zip(suppliers, results):
+                if result is None:
+                    continue
+
+                name, summary, sheets, key, entry, widths = result
+
+                self.__get_record(name).update(summary)
+                self.__widths.update(widths)
+
+                if entry is not None:
+                    self.__manifest.update(entry)
+
+                if sheets is None:
+                    continue
+
+                try:
+                    self._save_sheets(
+                        name,
+                        *sheets,
+                        use_mode,
+                        include_reports,
+                        key
+                    )
+                except Exception as e:
+                    logging.error(
+                        f'Exception {e} occurred in supplier {supplier}',
+                        exc_info=True
+                    )
+
+    @_copy_on_write
     def run(
             self,
             suppliers: list = [],
             use_mode: bool = True,
-            include_reports: bool = False) -> None:
+            include_reports: bool = False,
+            workers: int = 1,
+            writers: int = 2,
+            constant_memory: bool = False,
+            single_file: bool = False,
+            skip_unchanged: bool = True,
+            strategy: str = 'greedy') -> None:
         """
         Main class to process data and save into Excel file
+
+        Args:
+            suppliers (list): suppliers to process, all if empty
+            use_mode (bool): True if 'Aprovechamiento' is incorporated
+            include_reports (bool): true if save previous reports into Excel file
+            workers (int): processes used to build the suppliers in parallel
+            writers (int): threads saving workbooks while the next suppliers
+                are built (sequential run), 0 to save them inline
+            constant_memory (bool): stream workbooks row by row, so memory
+                does not depend on the sheet size
+            single_file (bool): write every supplier and the summary into
+                one workbook (Reportes.xlsx) instead of a file per supplier
+            skip_unchanged (bool): keep the workbooks whose inputs did not
+                change since they were saved (manifest.json in path_to)
+            strategy (str): reallocation of out-of-period rows, 'greedy'
+                (rows by descending 'Nota' until the difference is reached)
+                or 'closest' (rows adding up closest to the difference,
+                within allocation.TIME_BUDGET seconds per supplier)
         """
+        if strategy not in allocation.STRATEGIES:
+            raise ValueError(
+                f'Unknown strategy "{strategy}", '
+                f'expected one of {list(allocation.STRATEGIES)}'
+            )
+
+        self.__constant_memory = constant_memory
+        self.__strategy = strategy
+
+        self.__skip_unchanged = skip_unchanged and not single_file \
+            and (use_mode or include_reports)
+
+        if self.__skip_unchanged:
+            self.__load_manifest()
+
         if not suppliers:
             suppliers = self.get_suppliers()
 
-        for supplier in suppliers:
-            try:
-                mask = self.__data.Grupo == supplier
-                df_ss = self.__data[mask]
-                self._process_data(
-                    df_ss,
-                    use_mode,
-                    include_reports
-                )
-            except Exception as e:
-                logging.error(
-                    f'Exception {e} occurred in supplier {supplier}',
-                    exc_info=True
-                )
+        self.__reallocated = self.__plan_reallocation(suppliers)
 
-        if use_mode:
-            self.__df_summ.reset_index(
-                drop=False,
-                inplace=True
-            )
+        # joined suppliers are gathered again on every run
+        self.__joined_keys = []
+        self.__df1_joined, self.__df2_joined = (
+            pd.DataFrame() for _ in range(2)
+        )
+
+        # a shared workbook is written from this thread only
+        writers = 0 if single_file else writers
 
-            self.__summary_to_excel()
+        with self.__open_book(single_file, use_mode, include_reports):
+            if workers > 1:
+                self.__run_parallel(
+                    suppliers,
+                    use_mode,
+                    include_reports,
+                    workers
+                )
+            else:
+                with ExcelWriterPool(self.__write_excel, writers) as pool:
+                    self.__writer = pool if writers > 0 else None
+
+                    for supplier in suppliers:
+                        try:
+                            df_ss = self.__get_supplier_data(supplier)
+                            self._process_data(
+                                df_ss,
+                                use_mode,
+                                include_reports
+                            )
+                        except Exception as e:
+                            logging.error(
+                                f'Exception {e} occurred in supplier {supplier}',
+                                exc_info=True
+                            )
+
+                self.__writer = None
+
+            if self.__skip_unchanged:
+                self.__save_manifest()
+
+            if use_mode:
+                self.__summary_to_excel()
@@ -1,4 +1,10 @@
+import os
+import pickle
+import hashlib
 import numbers
+import numpy as np
+import pandas as pd
+from pandas.core.series import Series
 from datetime import datetime
 
 MONTHS = \
@@ -46,3 +52,156 @@ def format_datetime(s: str) -> datetime:
         f'{d[0]}/{MONTHS[d[1]]}/{d[2]}',
         '%d/%m/%Y'
     )
+
+
+def parse_dates(values: Series) -> Series:
+    """
+    Vectorized format_datetime. Each distinct 'dd-mmm.-yyyy' string is
+    parsed once and the result is broadcast back to every row.
+
+    Args:
+        values (Series): Advance dates ('05-ene.-2023', optional time part)
+
+    Returns:
+        Series: datetime64 values, NaT where the date is not valid
+    """
+    codes, uniques = pd.factorize(values)
+
+    parts = (
+        pd.Series(uniques, dtype='string')
+        .str.split(' ', n=1).str[0]
+        .str.split('-', expand=True)
+    )
+
+    parsed = pd.DatetimeIndex(
+        pd.to_datetime(
+            parts[0] + '/' + parts[1].map(MONTHS) + '/' + parts[2],
+            format='%d/%m/%Y',
+            errors='coerce'
+        )
+    )
+
+    return pd.Series(
+        parsed.take(codes, allow_fill=True, fill_value=pd.NaT),
+        index=values.index,
+        name=values.name
+    )
+
+
+def in_period(dates: Series, masks, start) -> np.ndarray:
+    """
+    Check each date against a day bitmask (bit 0 is the day of start)
+
+    Args:
+        dates (Series): datetime64 values
+        masks (int | array-like): bitmask, one for all rows or one per row
+        start (Timestamp): first day of the period
+
+    Returns:
+        np.ndarray: True where the day bit of the date is set
+    """
+    days = (
+        (dates.to_numpy(dtype='datetime64[ns]') - np.datetime64(start, 'ns'))
+        .astype('timedelta64[D]')
+        .astype(np.int64)
+    )
+
+    valid = (days >= 0) & (days < 63)
+    bits = np.right_shift(np.asarray(masks, dtype=np.int64), np.where(valid, days, 0))
+
+    return valid & (bits & 1).astype(bool)
+
+
+def file_digest(path: str, block_size: int = 1 << 20) -> str:
+    """
+    Content hash of a file, read in blocks
+    """
+    digest = hashlib.blake2b(digest_size=16)
+
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def file_fingerprint(path: str) -> dict:
+    """
+    Size, modification time and content hash of a file
+    """
+    stat = os.stat(path)
+
+    return {
+        'size': stat.st_size,
+        'mtime': stat.st_mtime_ns,
+        'hash': file_digest(path)
+    }
+
+
+def is_same_file(path: str, fingerprint: dict) -> bool:
+    """
+    Check a file against a stored fingerprint. The content hash is only
+    computed when size and modification time still match.
+    """
+    if not fingerprint:
+        return False
+
+    stat = os.stat(path)
+
+    if (stat.st_size != fingerprint.get('size') or
+            stat.st_mtime_ns != fingerprint.get('mtime')):
+        return False
+
+    return file_digest(path) == fingerprint.get('hash')
+
+
+def read_keyed_cache(path: str, sources: list, version: int):
+    """
+    Load a cache written by write_keyed_cache. Its key is pickled ahead of
+    the payload, so the payload is only read when every source matches.
+
+    Args:
+        path (str): cache file path
+        sources (list): paths of the source files
+        version (int): expected cache version
+
+    Returns:
+        Payload, None if the cache is missing or outdated
+    """
+    if not os.path.exists(path):
+        return None
+
+    with open(path, 'rb') as f:
+        key = pickle.load(f)
+
+        if key.get('version') != version:
+            return None
+
+        if len(key.get('sources', [])) != len(sources):
+            return None
+
+        for source, fingerprint in zip(sources, key['sources']):
+            if not is_same_file(source, fingerprint):
+                return None
+
+        return pickle.load(f)
+
+
+def write_keyed_cache(path: str, sources: list, version: int, payload) -> None:
+    """
+    Pickle a payload after a key made of the source fingerprints
+
+    Args:
+        path (str): cache file path
+        sources (list): paths of the source files
+        version (int): cache version
+        payload: object to store
+    """
+    key = {
+        'version': version,
+        'sources': [file_fingerprint(source) for source in sources]
+    }
+
+    with open(path, 'wb') as f:
+        pickle.dump(key, f, protocol=pickle.HIGHEST_PROTOCOL)
+        pickle.dump(payload, f, protocol=pickle.HIGHEST_PROTOCOL)